@@ -1,4 +1,7 @@
 # encoding=utf-8
+import time
+import threading
+
 from weixin.config import *
 
 
@@ -35,3 +38,49 @@ def test_config():
     assert config.a == 0
     assert config.b == 1
 
+
+def test_config_lazy():
+    created = []
+
+    def factory():
+        created.append(1)
+        return "value"
+
+    config = Config()
+    config.set_lazy("lazy", factory)
+    assert not created
+
+    assert config.lazy == "value"
+    assert config["lazy"] == "value"
+    assert created == [1]
+
+    config.set_lazy("other", lambda: object())
+    assert config.is_lazy("other")
+    copied = config.copy()
+    assert not config.is_lazy("other")
+    assert copied.other is config.other
+    assert config.get("other") is config.other
+    assert dict(config.items())["lazy"] == "value"
+    assert config.get("missing", 1) == 1
+
+
+def test_config_lazy_threads():
+    created = []
+
+    def factory():
+        time.sleep(0.05)
+        created.append(1)
+        return object()
+
+    config = Config()
+    config.set_lazy("lazy", factory)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(config.lazy))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert created == [1]
+    assert all(r is results[0] for r in results)
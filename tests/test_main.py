@@ -0,0 +1,266 @@
+# encoding=utf-8
+import os
+import re
+import threading
+
+import pytest
+
+from weixin.main import Weechat
+
+
+text_msg = """<xml>
+<ToUserName><![CDATA[toUser]]></ToUserName>
+<FromUserName><![CDATA[fromUser]]></FromUserName>
+<CreateTime>123456789</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[%s]]></Content>
+<MsgId>123456789</MsgId>
+</xml>
+"""
+
+
+def make_app():
+    app = Weechat(token='A'*20, appid='wx' + 'a'*16)
+    called = []
+
+    def handler(name):
+        def h(request):
+            called.append(name)
+        return h
+
+    return app, called, handler
+
+
+def test_text_filter():
+    app, called, handler = make_app()
+
+    app.text_filter(["签到", "簽到"])(handler("sign"))
+    app.text_filter(r"^天气(\w+)$")(handler("weather"))
+    app.text_filter(["帮助"])(handler("help"))
+    app.text_filter(r"^帮")(handler("prefix"))
+    app.as_text_filter_default(handler("default"))
+
+    for content in [" 签到 ", "簽到", "天气北京", "帮助", "帮我", "你好"]:
+        app.reply(text_msg % content)
+
+    assert called == ["sign", "sign", "weather", "help", "prefix", "default"]
+
+    # 后注册的处理器同样生效
+    app.text_filter(["你好"])(handler("hello"))
+    app.reply(text_msg % "你好")
+    assert called[-1] == "hello"
+
+
+def test_text_filter_keywords():
+    app, called, handler = make_app()
+
+    app.text_filter(["a", "b"])(handler("first"))
+    app.text_filter(["b", "c"])(handler("second"))
+    app.text_filter(["d.*"])(handler("regex"))
+
+    for content in ["a", "b\n", "c", "dxx", "x"]:
+        app.reply(text_msg % content)
+
+    assert called == ["first", "first", "second", "regex"]
+
+
+def test_text_filter_after_text():
+    app, called, handler = make_app()
+
+    app.text(handler("text"))
+    app.text_filter(["hi"])(handler("hi"))
+    app.reply(text_msg % "hi")
+    assert called == ["hi"]
+
+    app.text(handler("text"))
+    app.reply(text_msg % "hi")
+    assert called == ["hi", "text"]
+
+
+def test_text_filter_blank_content():
+    app, called, handler = make_app()
+
+    app.image(handler("image"))
+    assert app.reply(text_msg % "   ") is None
+    assert app.reply(text_msg % "") is None
+
+    app.text_filter(["签到"])(handler("sign"))
+    app.as_text_filter_default(handler("default"))
+    app.reply(text_msg % "   ")
+    assert called == ["default"]
+
+
+def test_default_receives_text():
+    app, called, handler = make_app()
+
+    # 未注册 text 或 text_filter 时, text消息交由 default 处理
+    app.default = handler("default")
+    app.reply(text_msg % "hello")
+    assert called == ["default"]
+
+
+def test_text_filter_literal_keywords():
+    app = make_app()[0]
+
+    # 中文关键词走纯文本匹配
+    assert isinstance(app._compile_text_filter(["签到", "簽到"]), frozenset)
+    assert not isinstance(app._compile_text_filter(["签.*"]), frozenset)
+
+
+event_msg = """<xml>
+<ToUserName><![CDATA[toUser]]></ToUserName>
+<FromUserName><![CDATA[fromUser]]></FromUserName>
+<CreateTime>123456789</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[%s]]></Event>
+<EventKey><![CDATA[%s]]></EventKey>
+</xml>
+"""
+
+
+def test_event_dispatch():
+    app, called, handler = make_app()
+
+    app.click_event(handler("click"))
+    app.click_event_filter("settings")(handler("settings"))
+    app.scan_event_filter("scene_1")(handler("scene"))
+    app.subscribe_event(handler("subscribe"))
+
+    for event, key in [("CLICK", "settings"), ("CLICK", "other"),
+                       ("SCAN", "scene_1"), ("SCAN", "scene_2"),
+                       ("subscribe", ""), ("CLICK", "SETTINGS")]:
+        app.reply(event_msg % (event, key))
+
+    assert called == ["settings", "click", "scene", "subscribe", "settings"]
+
+
+def test_get_base_handler():
+    app, called, handler = make_app()
+
+    image = handler("image")
+    app.image(image)
+    assert app.get_base_handler(["image"]) is image
+    assert app.get_base_handler(["voice", "IMAGE"]) is image
+    assert app.get_base_handler(["voice"]) is app.default
+
+
+def test_on_finish():
+    app, called, handler = make_app()
+
+    app.reply(text_msg % "hello")
+    app.on_finish(handler("finish"))
+    app.text(handler("text"))
+    app.reply(text_msg % "hello")
+
+    assert called == ["text", "finish"]
+
+
+def test_text_filter_compiled_pattern():
+    app, called, handler = make_app()
+
+    app.text_filter(re.compile(r"^hello$", re.I))(handler("hello"))
+    app.text_filter(re.compile(r"^world$"))(handler("world"))
+
+    for content in ["HELLO", "world", "World"]:
+        app.reply(text_msg % content)
+
+    assert called == ["hello", "world"]
+
+
+def test_initialize_lazy(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    app, called, handler = make_app()
+    app.add_config("enc_aeskey", 'E5HSDyJ78YwCSelWbCSFb4ZcXXSN1LQPdkHPblR8ilo')
+    app.initialize()
+
+    sqlite_file = "weixin.%s.sqlite3" % app.config.appid
+    assert not os.path.exists(sqlite_file)
+
+    assert app.storage is app.config.storage
+    assert os.path.exists(sqlite_file)
+    assert app.cryptor is app.config.cryptor
+
+
+def test_reply_unhandled():
+    app, called, handler = make_app()
+
+    # 无image处理器时不会解析xml, 残缺的xml也不会引发异常
+    broken = b"<xml><MsgType><![CDATA[image]]></MsgType>"
+    assert app.reply(broken) is None
+
+    app.image(handler("image"))
+    app.reply(text_msg.replace("text", "image").encode())
+    assert called == ["image"]
+
+
+def test_text_filter_uncombinable():
+    app, called, handler = make_app()
+
+    app.text_filter(r"(?u)\w+x")(handler("inline"))
+    app.text_filter(r"(?i)^hello$")(handler("hello"))
+    app.text_filter(r"^world$")(handler("world"))
+
+    for content in ["abcx", "HELLO", "WORLD", "world"]:
+        app.reply(text_msg % content)
+
+    assert called == ["inline", "hello", "world"]
+
+
+def test_text_filter_many():
+    app, called, handler = make_app()
+
+    for i in range(250):
+        app.text_filter(r"^kw%d$" % i)(handler(i))
+
+    for content in ["kw0", "kw98", "kw99", "kw249", "kw250"]:
+        app.reply(text_msg % content)
+
+    assert called == [0, 98, 99, 249]
+
+
+def test_reply_unhandled_encrypted():
+    app = make_app()[0]
+
+    encrypted = (b"<xml><MsgType><![CDATA[image]]></MsgType>"
+                 b"<Encrypt><![CDATA[xxx]]></Encrypt></xml>")
+    with pytest.raises(Exception) as excinfo:
+        app.reply(encrypted)
+
+    assert "enc_aeskey is not set" in str(excinfo.value)
+
+
+def test_text_filter_concurrent_register():
+    app, called, handler = make_app()
+
+    def register(start):
+        for i in range(start, start + 50):
+            app.text_filter(["kw%d" % i])(handler(i))
+
+    threads = [threading.Thread(target=register, args=(n * 50,))
+               for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(app.text_filter_handlers) == 200
+    app.reply(text_msg % "kw199")
+    assert called == [199]
+
+
+def test_text_filter_regex_engine():
+    regex = pytest.importorskip("regex")
+    app, called, handler = make_app()
+
+    app.text_filter(re.compile(r"^hello$"))(handler("re"))
+    app.text_filter(regex.compile(r"^hel"))(handler("regex"))
+    app.text_filter(r"^h")(handler("str"))
+    app.text_filter(regex.compile(r"^wor", regex.I))(handler("flags"))
+
+    for content in ["hello", "help", "hi", "WORLD"]:
+        app.reply(text_msg % content)
+
+    assert called == ["re", "regex", "str", "flags"]
+
+    # 默认flags的表达式合并为一个, 带flags的单独匹配
+    assert [len(h) for _, h in app._combined_filter] == [3, 1]
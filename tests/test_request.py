@@ -72,3 +72,21 @@ def test_request(config, umsg):
     req.response(msg)
     resp_msg = WeixinMsg(req.get_response_xml())
     assert_reply(resp_msg)
+
+
+def test_request_dispatch_key():
+    req = WeixinRequest(Config(**common_cfg), text_msg)
+    assert req.dispatch_key() == ('TEXT', None, None)
+
+    event_msg = """
+    <xml>
+    <ToUserName><![CDATA[toUser]]></ToUserName>
+    <FromUserName><![CDATA[fromUser]]></FromUserName>
+    <CreateTime>123456789</CreateTime>
+    <MsgType><![CDATA[event]]></MsgType>
+    <Event><![CDATA[CLICK]]></Event>
+    <EventKey><![CDATA[settings]]></EventKey>
+    </xml>
+    """
+    req = WeixinRequest(Config(**common_cfg), event_msg)
+    assert req.dispatch_key() == ('EVENT', 'CLICK', 'settings')
@@ -1,10 +1,74 @@
 # encoding=utf-8
+import threading
+
 from .utils import AttributeDict, json_loads
 
 __all__ = ['Config',]
 
+# 保证延迟配置项在多线程下只初始化一次, 初始化时可能读取其他延迟配置项
+_lazy_lock = threading.RLock()
+
+
+class _LazyValue(object):
+    """
+    延迟初始化的配置项, 首次读取时才调用 factory 生成配置值
+    """
+    __slots__ = ('factory',)
+
+    def __init__(self, factory):
+        self.factory = factory
+
 
 class Config(AttributeDict):
+    """
+    set_lazy 设置的配置项在通过 config.key, config[key], get, items,
+    values, copy 读取时才会初始化; dict(config) 等直接复制底层字典的操作
+    得到的是未初始化的配置项
+    """
+
+    def _resolve(self, key, value):
+        if isinstance(value, _LazyValue):
+            with _lazy_lock:
+                # 可能已被其他线程初始化
+                value = dict.get(self, key)
+                if isinstance(value, _LazyValue):
+                    value = value.factory()
+                    self.set(key, value)
+
+        return value
+
+    def __getitem__(self, key):
+        return self._resolve(key, super(Config, self).__getitem__(key))
+
+    __getattr__ = __getitem__
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        return default
+
+    def items(self):
+        return [(k, self[k]) for k in list(self.keys())]
+
+    def values(self):
+        return [self[k] for k in list(self.keys())]
+
+    def copy(self):
+        return Config(self.items())
+
+    def set_lazy(self, key, factory):
+        """
+        >>> config.set_lazy('storage', lambda: Sqlite3Storage())
+        >>> config.storage  # 此时才会创建 Sqlite3Storage
+        """
+        self.set(key, _LazyValue(factory))
+
+    def is_lazy(self, key):
+        """
+        配置项是否为尚未初始化的延迟配置项
+        """
+        return isinstance(dict.get(self, key), _LazyValue)
 
     def from_object(self, config_object, lower_keys=False):
         for k in dir(config_object):
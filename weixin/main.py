@@ -1,17 +1,79 @@
 # encoding=utf-8
 import re
+import threading
+from itertools import groupby
+
+try:
+    # 可选依赖: regex 模块匹配多分支表达式时通常比 re 更快
+    import regex as _regex
+except ImportError:
+    _regex = re
 
 from .config import Config
 from .crypto import XMLMsgCryptor
 from .request import WeixinRequest
 from .storage import Sqlite3Storage
+from .utils import to_str
 
 
 __all__ = ['Weechat',]
 
+# 各正则引擎已编译表达式的类型, 及未指定任何flags时表达式所带的flags
+_DEFAULT_RE_FLAGS = {
+    type(engine.compile('')): engine.compile('').flags
+    for engine in (re, _regex)
+}
+_PATTERN_TYPES = tuple(_DEFAULT_RE_FLAGS)
+# 正则表达式的元字符, 不含这些字符的关键词按纯文本匹配
+_RE_META = frozenset('.^$*+?{}[]\\|()')
+# 含内联flags的表达式合并后会影响其他分支或无法编译
+_INLINE_FLAGS_RE = re.compile(r'\(\?[aiLmsux]')
+# Python3.4 的 re 最多支持100个分组, 每个合并后的表达式最多包含的分支数
+_MAX_COMBINED_GROUPS = 99
+
+# 用于在解析xml之前获取消息类型
+_MSGTYPE_RE = re.compile(
+    r'<MsgType>\s*<!\[CDATA\[(\w+)\]\]>\s*</MsgType>')
+_MSGTYPE_BYTES_RE = re.compile(_MSGTYPE_RE.pattern.encode())
+
+# 消息类型, 事件类型等取值有限, 缓存其大写形式及拼接出的处理器key
+_CACHE_SIZE = 4096
+_uniform_cache = {}
+_event_keys_cache = {}
+
+
+def _default_handler(request):
+    return None
+
+
+def _base_handler_decorator(key, doc):
+    """
+    生成一个将函数注册为 key 对应处理器的装饰器方法
+    """
+    key = key.upper()
+
+    def decorator(self, function):
+        self.handlers[key] = function
+        return function
+
+    decorator.__doc__ = doc
+    return decorator
+
 
 class Weechat(object):
 
+    # 动态数据应通过 add_config 存入 self.config
+    __slots__ = (
+        'config',
+        'handlers',
+        'default',
+        'text_filter_handlers',
+        'text_filter_default',
+        '_on_finish',
+        '_combined_filter',
+        '_filter_lock',
+    )
+
     def __init__(self, token=None, appid=None, appsec=None, enc_aeskey=None):
         self.config = Config()
 
@@ -21,15 +83,22 @@ class Weechat(object):
         self.add_config("appsec", appsec)
         self.add_config("enc_aeskey", enc_aeskey)
 
-        default = lambda req: None
+        default = _default_handler
 
         self.handlers = dict()
         # 未知消息类型的处理器
         self.default = default
-        # 关键字处理器数组
+        # 关键字处理器数组, 仅由 text_filter 修改, 直接修改不会生效
         self.text_filter_handlers = []
         # 默认关键字无匹配处理器
         self.text_filter_default = default
+        # 消息处理完毕后调用的处理器
+        self._on_finish = default
+        # 由 text_filter_handlers 合并后的关键字表达式,
+        # 注册后置空, 首次匹配时生成
+        self._combined_filter = None
+        # 注册关键字处理器及生成合并表达式时加锁
+        self._filter_lock = threading.Lock()
 
     def initialize(self):
         appid = self.config.appid
@@ -39,18 +108,27 @@ class Weechat(object):
         if not appid or not token:
             raise Exception("appid or token not set!")
 
+        # 加解密器和存储器在首次使用时才创建
         if enc_aeskey:
-            self.add_config("cryptor", XMLMsgCryptor(
+            self.config.set_lazy("cryptor", lambda: XMLMsgCryptor(
                     appid=appid,
                     token=token,
                     enc_aeskey=enc_aeskey
                 )
             )
 
-        if self.config.storage is None:
+        if not self.config.is_lazy("storage") and self.config.storage is None:
             sqlite_file = "weixin.%s.sqlite3" % appid
-            storage = Sqlite3Storage(uri=sqlite_file)
-            self.set_storage(storage)
+            self.config.set_lazy(
+                "storage", lambda: Sqlite3Storage(uri=sqlite_file))
+
+    @property
+    def cryptor(self):
+        return self.config.cryptor
+
+    @property
+    def storage(self):
+        return self.config.storage
 
     def add_config(self, key, value):
         """
@@ -79,7 +157,13 @@ class Weechat(object):
         """
         将key转换为大写
         """
-        return key.upper()
+        value = _uniform_cache.get(key)
+        if value is None:
+            value = key.upper()
+            if len(_uniform_cache) < _CACHE_SIZE:
+                _uniform_cache[key] = value
+
+        return value
 
     def add_base_handler(self, key, function):
         """
@@ -90,170 +174,201 @@ class Weechat(object):
         return
 
     def get_base_handler(self, key_list):
+        """
+        按顺序查找处理器
+        """
+        handlers = self.handlers
         for k in key_list:
-            k = self.uniform(k)
-            h = self.handlers.get(k, None)
-            if callable(h):
+            h = handlers.get(self.uniform(k))
+            if h is not None:
                 return h
 
         return self.default
 
-    def text(self, function):
-        """
-        装饰 MsgType=text （文本消息）的处理器
-        """
-        self.add_base_handler("text", function)
-        return function
-
-    def image(self, function):
-        """
-        装饰 MsgType=image（图片消息） 的处理器
-        """
-        self.add_base_handler("image", function)
-        return function
-
-    def voice(self, function):
-        """
-        装饰 MsgType=voice（语音消息) 的处理器
-        """
-        self.add_base_handler("voice", function)
-        return function
-
-    def video(self, function):
-        """
-        装饰 MsgType=video（视频消息） 的处理器
-        """
-        self.add_base_handler("video", function)
-        return function
-
-    def shortvideo(self, function):
-        """
-        装饰 MsgType=shortvideo（短视频消息） 的处理器
-        """
-        self.add_base_handler("shortvideo", function)
-        return function
-
-    def location(self, function):
-        """
-        装饰 MsgType=location（位置消息） 的处理器
-        """
-        self.add_base_handler("location", function)
-        return function
-
-    def link(self, function):
-        """
-        装饰 MsgType=text 的处理器
-        """
-        self.add_base_handler("link", function)
-        return function
-
-    def subscribe_event(self, function):
-        """
-        装饰 MsgType=event, Event=subscribe 的处理器
-        """
-        self.add_base_handler("event_subscribe", function)
-        return function
-
-    def unsubscribe_event(self, function):
-        """
-        装饰 MsgType=event, Event=unsubscribe 的处理器
-        """
-        self.add_base_handler("event_unsubscribe", function)
-        return function
-
-    def location_event(self, function):
-        """
-        装饰 MsgType=event, Event=location 的处理器
-        """
-        self.add_base_handler("event_location", function)
-        return function
-
-    def view_event(self, function):
-        """
-        装饰 MsgType=event, Event=view 的处理器
-        """
-        self.add_base_handler("event_view", function)
-        return function
-
-    def click_event(self, function):
-        """
+    text = _base_handler_decorator(
+        "text", "装饰 MsgType=text （文本消息）的处理器")
+    image = _base_handler_decorator(
+        "image", "装饰 MsgType=image（图片消息） 的处理器")
+    voice = _base_handler_decorator(
+        "voice", "装饰 MsgType=voice（语音消息) 的处理器")
+    video = _base_handler_decorator(
+        "video", "装饰 MsgType=video（视频消息） 的处理器")
+    shortvideo = _base_handler_decorator(
+        "shortvideo", "装饰 MsgType=shortvideo（短视频消息） 的处理器")
+    location = _base_handler_decorator(
+        "location", "装饰 MsgType=location（位置消息） 的处理器")
+    link = _base_handler_decorator(
+        "link", "装饰 MsgType=link（链接消息） 的处理器")
+    subscribe_event = _base_handler_decorator(
+        "event_subscribe", "装饰 MsgType=event, Event=subscribe 的处理器")
+    unsubscribe_event = _base_handler_decorator(
+        "event_unsubscribe", "装饰 MsgType=event, Event=unsubscribe 的处理器")
+    location_event = _base_handler_decorator(
+        "event_location", "装饰 MsgType=event, Event=location 的处理器")
+    view_event = _base_handler_decorator(
+        "event_view", "装饰 MsgType=event, Event=view 的处理器")
+    click_event = _base_handler_decorator(
+        "event_click", """
         装饰 MsgType=event, Event=click 的处理器
         注意：
         当此装饰器与click_event_filter一起使用时，click_event_filter
         的优先级高，所以仅当无匹配click event key时被装饰的方法才会被调用
-        """
-        self.add_base_handler("event_click", function)
-        return function
+        """)
+    scan_event = _base_handler_decorator(
+        "event_scan", "扫描带参数二维码事件")
 
     def click_event_filter(self, key):
         """
         为click事件的一个eventkey绑定一个处理器
         """
+        full_key = self.uniform("event_click_%s" % key)
+
         def register(function):
             # 注册点击事件的处理器
-            self.add_base_handler("event_click_%s" % key, function)
+            self.handlers[full_key] = function
             return function
 
         return register
 
-    def scan_event(self, function):
-        """
-        扫描带参数二维码事件
-        """
-        self.add_base_handler("event_scan", function)
-        return function
-
     def scan_event_filter(self, scene):
         """
         为scan事件的一个场景绑定一个处理器
         """
+        full_key = self.uniform("event_scan_%s" % scene)
+
         def register(function):
             # 注册扫描事件的处理器
-            self.add_base_handler("event_scan_%s" % scene, function)
+            self.handlers[full_key] = function
             return function
 
         return register
 
     def _compile_text_filter(self, filter_):
         if isinstance(filter_, list):
-            # 关键词数组, 编译关键词表达式
-            regex = '^\s*(%s)\s*$' % '|'.join(filter_)
-            return re.compile(regex)
+            if not any(c in _RE_META for kw in filter_ for c in kw):
+                # 纯文本关键词, 去掉首尾空白后直接查找即可
+                return frozenset(filter_)
 
-        elif isinstance(filter_, str):
-            # 编译自定义的正则表达式
-            return re.compile(filter_)
+            # 关键词数组中含有正则表达式, 编译关键词表达式
+            regex = r'\A\s*(?:%s)\s*\Z' % '|'.join(filter_)
+            return _regex.compile(regex)
 
-        elif isinstance(filter_, re._pattern_type):
+        elif isinstance(filter_, _PATTERN_TYPES):
             # 已编译的正则表达式，直接返回
             return filter_
 
+        elif isinstance(filter_, str):
+            # 编译自定义的正则表达式
+            return _regex.compile(filter_)
+
         raise Exception(
             "filter is not list, str or re_pattern.")
 
+    def _text_filter_kind(self, filter_):
+        if isinstance(filter_, frozenset):
+            return "keywords"
+
+        # 带捕获分组或自定义flags的表达式无法安全地合并, 单独匹配
+        if (isinstance(filter_.pattern, str) and not filter_.groups
+                and filter_.flags == _DEFAULT_RE_FLAGS[type(filter_)]
+                and not _INLINE_FLAGS_RE.search(filter_.pattern)):
+            return "regex"
+
+    def _combine_text_filters(self, filter_handlers):
+        """
+        将相邻的可合并表达式合并为一个带命名分组的正则表达式,
+        匹配时通过 lastgroup 找到对应的处理器, 同时保持注册顺序的优先级.
+        相邻的纯文本关键词合并为一个 关键词->处理器 的字典
+        """
+        combined = []
+        groups = groupby(filter_handlers,
+                         key=lambda item: self._text_filter_kind(item[0]))
+
+        for kind, items in groups:
+            items = list(items)
+            if kind == "keywords":
+                table = {}
+                for keywords, h in items:
+                    for kw in keywords:
+                        # 先注册的处理器优先
+                        table.setdefault(kw, h)
+                combined.append((table, None))
+
+            elif kind == "regex":
+                for start in range(0, len(items), _MAX_COMBINED_GROUPS):
+                    block = items[start:start + _MAX_COMBINED_GROUPS]
+                    regex = '|'.join('(?P<h%d>%s)' % (i, cpre.pattern)
+                                     for i, (cpre, _) in enumerate(block))
+                    try:
+                        cpre = _regex.compile(regex)
+                    except _regex.error:
+                        # 无法合并, 逐个单独匹配
+                        combined.extend((cpre, [h]) for cpre, h in block)
+                    else:
+                        combined.append((cpre, [h for _, h in block]))
+
+            else:
+                combined.extend((cpre, [h]) for cpre, h in items)
+
+        return combined
+
+    def _dispatch_text_filters(self, request):
+        """
+        text类型消息的关键词路由
+        """
+        combined = self._combined_filter
+        if combined is None:
+            with self._filter_lock:
+                combined = self._combined_filter
+                if combined is None:
+                    combined = self._combine_text_filters(
+                        self.text_filter_handlers)
+                    self._combined_filter = combined
+
+        content = request.message.Content
+        if content is None:
+            # 空白的文本消息解析后Content为None, 视为无匹配关键词
+            return self.text_filter_default(request)
+
+        stripped = content.strip()
+        for cpre, handlers in combined:
+            if handlers is None:
+                h = cpre.get(stripped)
+                if h is not None:
+                    break
+                continue
+
+            m = cpre.match(content)
+            if m:
+                if len(handlers) == 1:
+                    h = handlers[0]
+                else:
+                    h = handlers[int(m.lastgroup[1:])]
+                break
+        else:
+            # 无匹配关键词, 调用默认处理器
+            h = self.text_filter_default
+
+        return h(request)
+
     def text_filter(self, kw_filter):
+        """
+        为匹配关键词数组, 正则表达式字符串或已编译的正则表达式的
+        text消息绑定一个处理器, 先注册的优先匹配.
+        须通过此方法注册, 直接修改 text_filter_handlers 不会生效.
+        安装了 regex 模块时字符串表达式由 regex 编译, 表达式有误时
+        抛出 regex.error 而非 re.error
+        """
         filter_ = self._compile_text_filter(kw_filter)
 
         def register(function):
-            self.text_filter_handlers.append((filter_, function))
-
-            @self.text
-            def handle_text_message(request):
-                ##
-                # 注册自定义的text类型消息处理器, 此处理器用于关键词路由
-                ##
-                content = request.message.Content
-                for cpre, h in self.text_filter_handlers:
-                    if cpre.match(content):
-                        break
-                else:
-                    # 无匹配关键词, 调用默认处理器
-                    h = self.text_filter_default
-
-                return h(request)
-            # register return
+            with self._filter_lock:
+                self.text_filter_handlers.append((filter_, function))
+                self._combined_filter = None
+            # 与 text 装饰器按注册顺序覆盖, 后注册的生效
+            self.handlers["TEXT"] = self._dispatch_text_filters
             return function
-        # decorator return
+
         return register
 
     def as_text_filter_default(self, function):
@@ -261,43 +376,88 @@ class Weechat(object):
         return function
 
     def on_finish(self, function):
-        self.add_base_handler("_on_finish_", function)
+        """
+        装饰消息处理完毕后调用的处理器
+        """
+        self._on_finish = function
         return function
 
-    def _get_msg_handler_key(self, message):
-        mtype = self.uniform(message.MsgType)
-        if mtype and mtype == self.uniform("EVENT"):
-            ev = self.uniform(message.Event)
-            main_h_key = "EVENT_%s" % ev
+    def _resolve_handler(self, request):
+        """
+        根据消息类型查找对应的处理器
+        """
+        mtype, ev, ev_key = request.dispatch_key()
+        # 检查MsgType是否存在, 不存在可能是因为
+        # 发送的是加密消息, 而enc_aeskey未设置导致获取属性时返回None
+        if not mtype:
+            return
+
+        handlers = self.handlers
+        if mtype != "EVENT":
+            return handlers.get(mtype, self.default)
+
+        keys = _event_keys_cache.get((ev, ev_key))
+        if keys is None:
+            main_h_key = "EVENT_" + ev
+            sub_h_key = None
             # 这几个事件都是有一个固定key的, 所以直接拼接成
             # 给主路由获取处理器用的key
-            if ev in ("CLICK", "SCAN",) and message.EventKey:
-                ev_key = self.uniform(message.EventKey)
-                sub_h_key = "EVENT_%s_%s" % (ev, ev_key)
+            if ev in ("CLICK", "SCAN",) and ev_key:
+                sub_h_key = main_h_key + "_" + self.uniform(ev_key)
 
-                return sub_h_key, main_h_key
-            else:
-                return main_h_key,
+            keys = sub_h_key, main_h_key
+            if len(_event_keys_cache) < _CACHE_SIZE:
+                _event_keys_cache[(ev, ev_key)] = keys
+
+        sub_h_key, main_h_key = keys
+        h = handlers.get(sub_h_key) if sub_h_key else None
+        return h or handlers.get(main_h_key, self.default)
+
+    def _is_unhandled(self, xmlbody):
+        """
+        不解析xml, 仅通过MsgType判断消息是否一定会被默认处理器忽略
+        """
+        if (self.default is not _default_handler
+                or self._on_finish is not _default_handler
+                or self.config.enc_aeskey):
+            return False
+
+        # 加密消息需交由正常流程处理, 以便在未设置enc_aeskey时报错
+        if isinstance(xmlbody, bytes):
+            if b"<Encrypt>" in xmlbody:
+                return False
+            m = _MSGTYPE_BYTES_RE.search(xmlbody)
+        elif isinstance(xmlbody, str):
+            if "<Encrypt>" in xmlbody:
+                return False
+            m = _MSGTYPE_RE.search(xmlbody)
+        else:
+            return False
 
-        return mtype,
+        if m is None:
+            return False
+
+        mtype = self.uniform(to_str(m.group(1)))
+        # 事件的处理器key由Event决定, 交由正常流程处理
+        return mtype != "EVENT" and mtype not in self.handlers
 
     def reply(self, xmlbody):
         """
         解析xml并查找对应处理器对消息做出回应,返回以渲染的xml字符串
         """
+        if self._is_unhandled(xmlbody):
+            # 没有处理器会处理此类型的消息, 无需解析xml
+            return
+
         req = WeixinRequest(self.config, xmlbody)
 
-        keys = self._get_msg_handler_key(req.message)
-        # 检查key是否存在, 不存在可能是因为
-        # 发送的是加密消息, 而enc_aeskey未设置导致获取属性时返回None
-        if not keys:
+        # 获取处理器
+        processer = self._resolve_handler(req)
+        if processer is None:
             return
 
-        # 获取处理器
-        processer = self.get_base_handler(keys)
-        on_finish = self.get_base_handler(["_on_finish_", ])
         result = processer(req)
-        on_finish(req)
+        self._on_finish(req)
 
         xml = req.get_response_xml(default=result)
         return xml
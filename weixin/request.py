@@ -52,6 +52,23 @@ class WeixinRequest(object):
 
         return self._weixin_msg_
 
+    def dispatch_key(self):
+        """
+        返回用于查找处理器的 (MsgType, Event, EventKey),
+        其中 MsgType 和 Event 已转换为大写
+        """
+        if not hasattr(self, '_dispatch_key_'):
+            msg = self.message
+            mtype = msg.MsgType
+            event = msg.Event
+            self._dispatch_key_ = (
+                mtype.upper() if mtype else mtype,
+                event.upper() if event else event,
+                msg.EventKey,
+            )
+
+        return self._dispatch_key_
+
     def _build_msg(self, msg):
         if isinstance(msg, BaseWeixinReply):
             if not msg._marked: